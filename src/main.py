@@ -1,83 +1,241 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import asyncio
+import ijson
+import jinja2
 import re
-import json
+import orjson
 import os
+import time
 import argparse
+import functools
+import shutil
 from collections import defaultdict
+from itertools import groupby
+from operator import attrgetter
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import configparser
 
-# Load CLIENT_ID and CLIENT_SECRET from external file
-with open("credentials.json", "r") as f:
-    credentials = json.load(f)
-
-CLIENT_ID = credentials.get("CLIENT_ID")
-CLIENT_SECRET = credentials.get("CLIENT_SECRET")
+@functools.cache
+def get_credentials():
+    """
+    Loads CLIENT_ID and CLIENT_SECRET from credentials.json on first use.
+    """
+    with open("credentials.json", "rb") as f:
+        return orjson.loads(f.read())
 
 # NHS Terminology Server OAuth2 Token Endpoint
 TOKEN_URL = "https://ontology.nhs.uk/authorisation/auth/realms/nhs-digital-terminology/protocol/openid-connect/token"
 
+# Bearer tokens are cached on disk and reused until they are close to expiry
+TOKEN_CACHE_PATH = ".token_cache.json"
+TOKEN_EXPIRY_MARGIN_SECONDS = 300
+
+# In auto mode, skip the version lookup if one completed within this interval
+VERSION_CHECK_STAMP_PATH = ".last_version_check"
+VERSION_CHECK_INTERVAL_SECONDS = 24 * 60 * 60
+
+# ETags and extracted codes for each raw SQL file, so unchanged files come back as 304s
+SQL_ETAG_CACHE_PATH = ".sql_etag_cache.json"
+
 # NHS Terminology Server API Endpoints
 LOOKUP_URL = "https://ontology.nhs.uk/production1/fhir/CodeSystem/$lookup"
 
-# Read the configuration from config.ini
-config = configparser.ConfigParser()
-config.read('src/config.ini')
+@functools.cache
+def get_preview_base_url():
+    """
+    Reads preview_base_url from the DEFAULT section of src/config.ini on first use.
+    """
+    config = configparser.ConfigParser()
+    config.read('src/config.ini')
+    return config['DEFAULT'].get('preview_base_url', '').strip()
+
+# dm+d codes are numbers of seven or more digits
+LONG_NUMBER_RE = re.compile(r'\b\d{7,}\b')
+
+# Versioned report filenames, e.g. dmd_lookup_report_202503_4_0.html
+REPORT_FILENAME_RE = re.compile(r"dmd_lookup_report_([\d_]+)\.html")
+
+# Concurrency limits and retry policy for GitHub fetches
+GITHUB_MAX_CONCURRENCY = 64
+GITHUB_LIMIT_PER_HOST = 16
+GITHUB_MAX_RETRIES = 3
+GITHUB_BACKOFF_SECONDS = 0.5
+
+# Codes are looked up in batch bundles of this size, several bundles at a time
+LOOKUP_BATCH_SIZE = 200
+LOOKUP_MAX_WORKERS = 8
+
+# Shared HTTP session so connections (and TLS handshakes) are reused across calls.
+# POST is retried too: every POST made here is a read-only token request or $lookup.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=["GET", "POST"],
+        raise_on_status=False,
+    ),
+))
+SESSION.headers.update({
+    'Accept': 'application/fhir+json, application/json',
+    'User-Agent': 'dmd_tests (+https://github.com/chrisjwood16/dmd_tests)'
+})
+
+def read_cached_token():
+    """
+    Returns the cached access token for the configured CLIENT_ID if it has more than
+    TOKEN_EXPIRY_MARGIN_SECONDS left to run, otherwise None.
+    """
+    try:
+        with open(TOKEN_CACHE_PATH, "rb") as f:
+            cache = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
 
-# Get the preview_base_url from the DEFAULT section
-PREVIEW_BASE_URL = config['DEFAULT'].get('preview_base_url', '').strip()
+    if cache.get("client_id") != get_credentials().get("CLIENT_ID"):
+        return None
+    if cache.get("expires_at", 0) - time.time() <= TOKEN_EXPIRY_MARGIN_SECONDS:
+        return None
+
+    return cache.get("access_token")
+
+def write_cached_token(access_token, expires_in):
+    """
+    Stores an access token and its absolute expiry time in the token cache.
+    The file is only readable by the current user.
+    """
+    cache = {
+        "client_id": get_credentials().get("CLIENT_ID"),
+        "access_token": access_token,
+        "expires_at": time.time() + expires_in
+    }
+    fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(orjson.dumps(cache))
+
+def invalidate_token_cache():
+    try:
+        os.remove(TOKEN_CACHE_PATH)
+    except FileNotFoundError:
+        pass
 
 def get_access_token():
     """
-    Retrieves an OAuth2 access token from the NHS Terminology Server.
+    Retrieves an OAuth2 access token from the NHS Terminology Server,
+    reusing the cached token while it is still valid.
     """
+    cached_token = read_cached_token()
+    if cached_token:
+        return cached_token
+
     headers = {
         'Content-Type': 'application/x-www-form-urlencoded'
     }
+    credentials = get_credentials()
     data = {
         'grant_type': 'client_credentials',
-        'client_id': CLIENT_ID,
-        'client_secret': CLIENT_SECRET
+        'client_id': credentials.get("CLIENT_ID"),
+        'client_secret': credentials.get("CLIENT_SECRET")
     }
     
-    response = requests.post(TOKEN_URL, headers=headers, data=data)
+    response = SESSION.post(TOKEN_URL, headers=headers, data=data)
 
     if response.status_code == 200:
-        return response.json().get('access_token')
+        token_data = orjson.loads(response.content)
+        access_token = token_data.get('access_token')
+        expires_in = token_data.get('expires_in')
+        if access_token and expires_in:
+            write_cached_token(access_token, expires_in)
+        return access_token
     else:
         raise Exception(f"Failed to obtain token: {response.status_code} - {response.text}")
 
+def post_with_token(url, access_token, headers, **kwargs):
+    """
+    POSTs to the NHS Terminology Server with a bearer token. If the token is
+    rejected with a 401, the cache is cleared and the request is retried once
+    with a freshly issued token.
+    """
+    response = SESSION.post(url, headers={**headers, 'Authorization': f'Bearer {access_token}'}, **kwargs)
+
+    if response.status_code == 401:
+        response.close()
+        invalidate_token_cache()
+        access_token = get_access_token()
+        response = SESSION.post(url, headers={**headers, 'Authorization': f'Bearer {access_token}'}, **kwargs)
+
+    return response
+
 def get_report_versions():
     """
-    Scans the reports directory and returns a list of dm+d version strings
-    extracted from filenames like: dmd_lookup_report_202503_4_0.html
-    Converts underscores back to dots.
+    Scans the reports directory in a single pass for filenames like:
+    dmd_lookup_report_202503_4_0.html
+    Returns (versions, version_files): the sorted dm+d version strings, with
+    underscores converted back to dots, and (date, version, filename) tuples
+    for the index page, newest first.
     """
     reports_dir = os.path.join(os.getcwd(), "reports")
     if not os.path.exists(reports_dir):
-        return []
+        return [], []
 
     versions = []
-    pattern = re.compile(r"dmd_lookup_report_([\d_]+)\.html")
+    version_files = []
+
+    with os.scandir(reports_dir) as entries:
+        for entry in entries:
+            filename = entry.name
+            if not (filename.startswith("dmd_lookup_report_") and filename.endswith(".html")):
+                continue
+
+            match = REPORT_FILENAME_RE.match(filename)
+            if not match or not entry.is_file():
+                continue
 
-    for filename in os.listdir(reports_dir):
-        match = pattern.match(filename)
-        if match:
-            raw_version = match.group(1)
-            version = raw_version.replace("_", ".")
+            version = match.group(1).replace("_", ".")
             versions.append(version)
 
-    return sorted(versions)        
-        
+            try:
+                dt = datetime.strptime(version.split('.')[0], "%Y%m")
+                version_files.append((dt, version, filename))
+            except ValueError:
+                continue
+
+    version_files.sort(reverse=True)
+
+    return sorted(versions), version_files
+
+def checked_recently():
+    """
+    Returns True if a dm+d version check completed within VERSION_CHECK_INTERVAL_SECONDS.
+    Uses the mtime of a local stamp file, as report mtimes are reset on every checkout.
+    """
+    try:
+        last_checked = os.stat(VERSION_CHECK_STAMP_PATH).st_mtime
+    except FileNotFoundError:
+        return False
+
+    return time.time() - last_checked < VERSION_CHECK_INTERVAL_SECONDS
+
+def record_version_check():
+    with open(VERSION_CHECK_STAMP_PATH, "a"):
+        pass
+    os.utime(VERSION_CHECK_STAMP_PATH)
+
 def get_dmd_version_via_lookup(access_token, code="96062004"):
     """
     Performs a $lookup on a known dm+d code (default: 96062004) to extract the current version.
     """
     url = "https://ontology.nhs.uk/production1/fhir/CodeSystem/$lookup"
     headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-        'Accept': 'application/json'
+        'Content-Type': 'application/json'
     }
 
     payload = {
@@ -88,7 +246,7 @@ def get_dmd_version_via_lookup(access_token, code="96062004"):
         ]
     }
 
-    response = requests.post(url, headers=headers, json=payload)
+    response = post_with_token(url, access_token, headers, data=orjson.dumps(payload))
 
     if response.status_code != 200:
         raise Exception(
@@ -100,7 +258,7 @@ def get_dmd_version_via_lookup(access_token, code="96062004"):
         )
 
     # Try to extract version from Parameters
-    parameters = response.json().get("parameter", [])
+    parameters = orjson.loads(response.content).get("parameter", [])
     for param in parameters:
         if param.get("name") == "version":
             return param.get("valueString")
@@ -120,49 +278,113 @@ def check_if_up_to_date(access_token):
     else:
         return False
            
-def extract_dmd_id_from_sql_files():
+def read_sql_etag_cache():
+    """
+    Returns the cached mapping of raw SQL URL → [etag, codes], or {} if there is none.
+    """
+    try:
+        with open(SQL_ETAG_CACHE_PATH, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+def write_sql_etag_cache(etag_cache):
+    with open(SQL_ETAG_CACHE_PATH, "wb") as f:
+        f.write(orjson.dumps(etag_cache))
+
+async def fetch_with_retry(session, semaphore, url, as_json=False, headers=None):
+    """
+    GETs a URL on a shared aiohttp session, retrying with exponential backoff
+    on 429 and 5xx responses. Returns (response, body); body is parsed JSON
+    when as_json is set and the request succeeded, otherwise the response text.
+    """
+    for attempt in range(GITHUB_MAX_RETRIES + 1):
+        async with semaphore:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 200:
+                    body = await response.json(loads=orjson.loads) if as_json else await response.text()
+                    return response, body
+
+                retryable = response.status == 429 or response.status >= 500
+                if not retryable or attempt == GITHUB_MAX_RETRIES:
+                    return response, await response.text()
+
+        await asyncio.sleep(GITHUB_BACKOFF_SECONDS * 2 ** attempt)
+
+async def extract_dmd_id_from_sql_files():
+    """
+    Scans the SQL file in each measure folder for dm+d codes.
+    Returns a dict mapping each unique code → list of (folder, folder_url) it appears in.
+    """
     base_api_url = "https://api.github.com/repos/bennettoxford/openprescribing-hospitals/contents/viewer/measures"
     raw_base_url = "https://raw.githubusercontent.com/bennettoxford/openprescribing-hospitals/main/viewer/measures"
     html_base_url = "https://github.com/bennettoxford/openprescribing-hospitals/tree/main/viewer/measures"
 
-    code_objects = []
-
-    response = requests.get(base_api_url)
-    if response.status_code != 200:
-        raise Exception(
-            f"Failed to fetch directory:\n"
-            f"Status Code: {response.status_code}\n"
-            f"Reason: {response.reason}\n"
-            f"URL: {response.url}\n"
-            f"Response Text: {response.text}"
-        )
-    
-    folders = [item['name'] for item in response.json() if item['type'] == 'dir']
-
-    for folder in folders:
-        folder_api_url = f"{base_api_url}/{folder}"
-        folder_html_url = f"{html_base_url}/{folder}"
-        folder_response = requests.get(folder_api_url)
+    code_to_folders = defaultdict(list)
+
+    semaphore = asyncio.Semaphore(GITHUB_MAX_CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit_per_host=GITHUB_LIMIT_PER_HOST)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        response, body = await fetch_with_retry(session, semaphore, base_api_url, as_json=True)
+        if response.status != 200:
+            raise Exception(
+                f"Failed to fetch directory:\n"
+                f"Status Code: {response.status}\n"
+                f"Reason: {response.reason}\n"
+                f"URL: {response.url}\n"
+                f"Response Text: {body}"
+            )
+
+        folders = [item['name'] for item in body if item['type'] == 'dir']
+
+        # Fetch every folder listing concurrently
+        folder_results = await asyncio.gather(*(
+            fetch_with_retry(session, semaphore, f"{base_api_url}/{folder}", as_json=True)
+            for folder in folders
+        ))
+
+        sql_files = []
+        for folder, (folder_response, files) in zip(folders, folder_results):
+            if folder_response.status != 200:
+                continue
 
-        if folder_response.status_code != 200:
+            sql_file = next((f for f in files if f['name'].endswith('.sql')), None)
+            if sql_file:
+                sql_files.append((folder, f"{raw_base_url}/{folder}/{sql_file['name']}"))
+
+        # Then fetch every discovered SQL file concurrently, revalidating cached copies by ETag
+        etag_cache = read_sql_etag_cache()
+        sql_results = await asyncio.gather(*(
+            fetch_with_retry(
+                session, semaphore, raw_url,
+                headers={"If-None-Match": etag_cache[raw_url][0]} if raw_url in etag_cache else None
+            )
+            for _, raw_url in sql_files
+        ))
+
+    # Only files seen on this run are kept, so the cache drops removed measures
+    new_etag_cache = {}
+
+    for (folder, raw_url), (sql_response, sql_text) in zip(sql_files, sql_results):
+        if sql_response.status == 304:
+            etag, codes = etag_cache[raw_url]
+        elif sql_response.status == 200:
+            etag = sql_response.headers.get("ETag")
+            codes = sorted(set(LONG_NUMBER_RE.findall(sql_text)))
+        else:
             continue
 
-        files = folder_response.json()
-        sql_file = next((f for f in files if f['name'].endswith('.sql')), None)
+        if etag:
+            new_etag_cache[raw_url] = [etag, codes]
 
-        if sql_file:
-            raw_url = f"{raw_base_url}/{folder}/{sql_file['name']}"
-            sql_response = requests.get(raw_url)
-
-            if sql_response.status_code == 200:
-                sql_text = sql_response.text
-                long_numbers = re.findall(r'\b\d{7,}\b', sql_text)
-                unique_numbers = set(long_numbers)
+        folder_html_url = f"{html_base_url}/{folder}"
+        for code in codes:
+            code_to_folders[code].append((folder, folder_html_url))
 
-                for code in unique_numbers:
-                    code_objects.append(DmdCode(code=code, folder=folder, url=folder_html_url))
+    write_sql_etag_cache(new_etag_cache)
 
-    return code_objects
+    return code_to_folders
 
 def build_lookup_bundle(codes, system_url="https://dmd.nhs.uk"):
     """
@@ -194,312 +416,320 @@ def build_lookup_bundle(codes, system_url="https://dmd.nhs.uk"):
 def send_lookup_bundle(access_token, bundle):
     """
     Sends a batch bundle to the NHS Terminology Server for $lookup.
+    Yields the response bundle's entries as they are parsed off the stream,
+    so the full response is never held in memory at once.
     """
     url = "https://ontology.nhs.uk/production1/fhir"  # Root FHIR endpoint for batches
     headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/fhir+json',
-        'Accept': 'application/fhir+json'
+        'Content-Type': 'application/fhir+json'
     }
 
-    response = requests.post(url, headers=headers, json=bundle)
+    response = post_with_token(url, access_token, headers, data=orjson.dumps(bundle), stream=True)
 
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise Exception(f"Batch lookup failed: {response.status_code} - {response.text}")
+    with response:
+        if response.status_code != 200:
+            raise Exception(f"Batch lookup failed: {response.status_code} - {response.text}")
+
+        response.raw.decode_content = True
+        yield from ijson.items(response.raw, "entry.item")
 
-        
-def parse_lookup_responses(response_bundle):
+def lookup_code_statuses(access_token, codes):
     """
-    Parses a response bundle from the NHS Terminology Server $lookup batch.
-    Returns a dict mapping code → status ('active', 'inactive', or 'unknown').
+    Looks up codes in batch bundles of LOOKUP_BATCH_SIZE, sending the bundles concurrently.
+    Returns a dict mapping code → status.
     """
+    batches = [codes[i:i + LOOKUP_BATCH_SIZE] for i in range(0, len(codes), LOOKUP_BATCH_SIZE)]
+
+    def lookup_batch(batch):
+        bundle = build_lookup_bundle(batch)
+        entries = send_lookup_bundle(access_token, bundle)
+        return dict(parse_lookup_responses(entries))
+
     status_map = {}
+    with ThreadPoolExecutor(max_workers=LOOKUP_MAX_WORKERS) as executor:
+        for batch_status_map in executor.map(lookup_batch, batches):
+            status_map.update(batch_status_map)
 
-    for entry in response_bundle.get("entry", []):
+    return status_map
+
+def parse_lookup_responses(entries):
+    """
+    Parses the entries of a response bundle from the NHS Terminology Server $lookup batch.
+    Yields (code, status) tuples, where status is 'active', 'inactive', or 'unknown'.
+    """
+    for entry in entries:
         resource = entry.get("resource", {})
         code = None
         status = "unknown"
 
         if resource.get("resourceType") == "Parameters":
-            parameters = resource.get("parameter", [])
-
-            # Extract code
-            for p in parameters:
-                if p.get("name") == "code":
+            # Single pass: pick up the code and the inactive property together
+            for p in resource.get("parameter", []):
+                name = p.get("name")
+                if name == "code":
                     code = p.get("valueCode")
+                elif name == "property":
+                    is_inactive_property = False
+                    inactive_value = None
+                    for part in p.get("part", []):
+                        part_name = part.get("name")
+                        if part_name == "code":
+                            is_inactive_property = is_inactive_property or part.get("valueCode") == "inactive"
+                        elif part_name == "value" and "valueBoolean" in part:
+                            inactive_value = part["valueBoolean"]
 
-            # Look for inactive property
-            for p in parameters:
-                if p.get("name") == "property":
-                    part_list = p.get("part", [])
-                    is_inactive_property = any(
-                        part.get("name") == "code" and part.get("valueCode") == "inactive"
-                        for part in part_list
-                    )
                     if is_inactive_property:
-                        for part in part_list:
-                            if part.get("name") == "value":
-                                if part.get("valueBoolean") is True:
-                                    status = "inactive"
-                                elif part.get("valueBoolean") is False:
-                                    status = "active"
+                        if inactive_value is True:
+                            status = "inactive"
+                        elif inactive_value is False:
+                            status = "active"
 
         elif resource.get("resourceType") == "OperationOutcome":
             diagnostics = resource.get("issue", [{}])[0].get("diagnostics", "")
-            match = re.search(r'\b\d{7,}\b', diagnostics)
+            match = LONG_NUMBER_RE.search(diagnostics)
             if match:
                 code = match.group(0)
             status = "unknown"
 
         if code:
-            status_map[code] = status
+            yield code, status
 
-    return status_map
-
-def write_dmd_lookup_report_html(code_objects, version):
+@functools.lru_cache(maxsize=1)
+def get_base64_image():
     """
-    Generates a styled HTML report for dm+d lookup results grouped by status and folder.
-    Filename is based on the CodeSystem version.
+    Reads the base64-encoded logo shared by the report and index pages.
+    The file is static, so it is only read once per process.
     """
-    reports_dir = os.path.join(os.getcwd(), "reports")
-    os.makedirs(reports_dir, exist_ok=True)
-
-    # Read base64 logo
-    image_path = os.path.join(os.getcwd(), "src", "base64_image.txt")
-    with open(image_path, "r") as file:
-        base64_image = file.read()
-
-    # Group by status → folder → list of codes
-    grouped = {
-        "unknown": defaultdict(list),
-        "inactive": defaultdict(list),
-        "active": defaultdict(list),
-    }
+    image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "base64_image.txt")
+    with open(image_path, "r") as f:
+        return f.read()
 
-    for obj in code_objects:
-        status = (obj.status or "unknown").lower()
-        grouped[status][obj.folder].append(obj)
+# Report and index pages are compiled once at import. Content is numeric codes,
+# folder names and URLs, so autoescaping is left off as in the original f-strings.
+TEMPLATE_ENV = jinja2.Environment(autoescape=False, trim_blocks=True)
 
-    link = f"https://github.com/chrisjwood16/dmd_tests/blob/main/reports/"
-
-    # Begin HTML
-    report = f"""
+REPORT_TEMPLATE = TEMPLATE_ENV.from_string("""
     <html>
     <head>
-    <title>dm+d Lookup Report – version {version}</title>
+    <title>dm+d Lookup Report – version {{ version }}</title>
     <style>
-        body {{
+        body {
             font-family: Arial, sans-serif;
             background-color: #f8f9fa;
             margin: 20px;
-        }}
-        .container {{
+        }
+        .container {
             max-width: 900px;
             margin: 0 auto;
             padding: 20px;
             background-color: white;
             border-radius: 10px;
             box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-        }}
-        header {{
+        }
+        header {
             text-align: center;
             margin-bottom: 30px;
-        }}
-        header img {{
+        }
+        header img {
             max-width: 650px;
-        }}
-        h2 {{
+        }
+        h2 {
             color: #222;
             margin-top: 40px;
-        }}
-        h3 {{
+        }
+        h3 {
             margin-top: 30px;
             color: #444;
-        }}
-        ul {{
+        }
+        ul {
             padding-left: 20px;
-        }}
-        li {{
+        }
+        li {
             margin-bottom: 4px;
-        }}
-        .status-box {{
+        }
+        .status-box {
             display: inline-block;
             padding: 3px 10px;
             border-radius: 5px;
             font-size: 0.9em;
-        }}
-        .active {{ background-color: #d7f0d2; color: #0f7b0f; }}
-        .inactive {{ background-color: #fbdcdc; color: #b30000; }}
-        .unknown {{ background-color: #fff6cc; color: #cc7a00; }}
+        }
+        .active { background-color: #d7f0d2; color: #0f7b0f; }
+        .inactive { background-color: #fbdcdc; color: #b30000; }
+        .unknown { background-color: #fff6cc; color: #cc7a00; }
     </style>
     </head>
     <body>
     <div class="container">
         <header>
-            <img src="{base64_image}" alt="OpenPrescribing logo" />
-            <h2>dm+d Lookup Report – version {version}</h2>
-            <div class="back-link"><p><a href="{PREVIEW_BASE_URL}{link}list_dmd_lookup_reports.html">← Back to all reports</a></p></div>
+            <img src="{{ base64_image }}" alt="OpenPrescribing logo" />
+            <h2>dm+d Lookup Report – version {{ version }}</h2>
+            <div class="back-link"><p><a href="{{ preview_base_url }}{{ link }}list_dmd_lookup_reports.html">← Back to all reports</a></p></div>
             <p>This report lists all dm+d codes extracted from SQL files in OpenPrescribing Hospitals and their lookup status via the NHS Terminology Server.</p>
         </header>
-    """
-
-    def render_status_section(label, css_class, folder_dict):
-        section_html = f"<h2>{label} <span class='status-box {css_class}'>{css_class.capitalize()}</span></h2>\n"
-        if not folder_dict:
-            return section_html + "<p>No codes found.</p>"
-        for folder in sorted(folder_dict.keys()):
-            objs = folder_dict[folder]
-            section_html += f"<h3>Folder: <a href='{objs[0].url}'>{folder}</a></h3>\n<ul>\n"
-            for obj in objs:
-                section_html += f"<li>{obj.code}</li>\n"
-            section_html += "</ul>\n"
-        return section_html
-
-    # Render sections in order
-    report += render_status_section("Unknown codes", "unknown", grouped["unknown"])
-    report += render_status_section("Inactive codes", "inactive", grouped["inactive"])
-    report += render_status_section("Active codes", "active", grouped["active"])
+    {% for label, css_class, folder_dict in sections %}
+<h2>{{ label }} <span class='status-box {{ css_class }}'>{{ css_class|capitalize }}</span></h2>
+{% if not folder_dict %}
+<p>No codes found.</p>{% else %}
+{% for folder, rows in folder_dict.items() %}
+<h3>Folder: <a href='{{ rows[0].url }}'>{{ folder }}</a></h3>
+<ul>
+{% for row in rows %}
+<li>{{ row.code }}</li>
+{% endfor %}
+</ul>
+{% endfor %}
+{% endif %}
+{% endfor %}
 
-    # Close HTML
-    report += """
     </div>
     </body>
     </html>
+    """)
+
+def write_dmd_lookup_report_html(code_rows, version):
     """
+    Generates a styled HTML report for dm+d lookup results grouped by status and folder.
+    Filename is based on the CodeSystem version.
+    """
+    reports_dir = os.path.join(os.getcwd(), "reports")
+    os.makedirs(reports_dir, exist_ok=True)
+
+    # Sort once by status → folder → code, then group; folders come out already in order
+    status_order = {"unknown": 0, "inactive": 1, "active": 2}
+    sorted_rows = sorted(code_rows, key=lambda row: (status_order[row.status], row.folder, row.code))
+
+    grouped = {status: {} for status in status_order}
+    for status, status_rows in groupby(sorted_rows, key=attrgetter("status")):
+        grouped[status] = {
+            folder: list(folder_rows)
+            for folder, folder_rows in groupby(status_rows, key=attrgetter("folder"))
+        }
+
+    link = f"https://github.com/chrisjwood16/dmd_tests/blob/main/reports/"
+
+    # Render sections in order
+    report = REPORT_TEMPLATE.render(
+        version=version,
+        base64_image=get_base64_image(),
+        preview_base_url=get_preview_base_url(),
+        link=link,
+        sections=[
+            ("Unknown codes", "unknown", grouped["unknown"]),
+            ("Inactive codes", "inactive", grouped["inactive"]),
+            ("Active codes", "active", grouped["active"]),
+        ]
+    )
 
     # Write file using version in name
     safe_version = version.replace(".", "_")
     filename = f"dmd_lookup_report_{safe_version}.html"
     filepath = os.path.join(reports_dir, filename)
-    with open(filepath, "w", encoding="utf-8") as f:
-        f.write(report)
-    filename = f"dmd_lookup_report_latest.html"
-    filepath = os.path.join(reports_dir, filename)
-    with open(filepath, "w", encoding="utf-8") as f:
+    temp_path = f"{filepath}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
         f.write(report)
+    os.replace(temp_path, filepath)
 
-    print(f"Report written to: {filepath}")
-
-def update_reports(access_token, version):
-    code_objects = extract_dmd_id_from_sql_files()
-    unique_codes = list({obj.code for obj in code_objects})
-    
-    bundle = build_lookup_bundle(unique_codes)
-    response_bundle = send_lookup_bundle(access_token, bundle)
-    status_map = parse_lookup_responses(response_bundle)
-
-    for obj in code_objects:
-        obj.set_status(status_map.get(obj.code, "unknown"))
-
-    #Testing for inactive/unknown codes - disable when live    
-    #code_objects[0].set_status('inactive')
-    #code_objects[1].set_status('unknown')
-
-    write_dmd_lookup_report_html(code_objects, version)
-    generate_dmd_lookup_index_html()
-
-    return code_objects
-
-def generate_dmd_lookup_index_html():
-    import os
-    import re
-    from datetime import datetime
+    # Hardlink latest to the versioned report rather than writing it twice.
+    # Git stores it as an ordinary file; a symlink would break the preview links.
+    latest_path = os.path.join(reports_dir, "dmd_lookup_report_latest.html")
+    try:
+        os.remove(latest_path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(filepath, latest_path)
+    except OSError:
+        shutil.copyfile(filepath, latest_path)
 
-    reports_dir = os.path.join(os.getcwd(), "reports")
+    print(f"Report written to: {latest_path}")
 
-    # Read base64 logo
-    image_path = os.path.join(os.getcwd(), "src", "base64_image.txt")
-    with open(image_path, "r") as f:
-        base64_image = f.read()
+def update_reports(access_token, version):
+    code_to_folders = asyncio.run(extract_dmd_id_from_sql_files())
+    status_map = lookup_code_statuses(access_token, list(code_to_folders))
 
-    # Get all report files
-    html_files = [
-        f for f in os.listdir(reports_dir)
-        if f.startswith("dmd_lookup_report_") and f.endswith(".html")
+    code_rows = [
+        DmdCode(code, status_map.get(code, "unknown"), folder, url)
+        for code, locations in code_to_folders.items()
+        for folder, url in locations
     ]
 
-    version_files = []
-    for filename in html_files:
-        match = re.match(r"dmd_lookup_report_([\d_]+)\.html", filename)
-        if match:
-            version_raw = match.group(1)
-            version = version_raw.replace("_", ".")
-            try:
-                dt = datetime.strptime(version.split('.')[0], "%Y%m")
-                version_files.append((dt, version, filename))
-            except ValueError:
-                continue
+    write_dmd_lookup_report_html(code_rows, version)
+    generate_dmd_lookup_index_html()
 
-    version_files.sort(reverse=True)
+    return code_rows
 
-    html_content = f"""
+INDEX_TEMPLATE = TEMPLATE_ENV.from_string("""
     <html>
     <head>
     <title>dm+d Lookup Reports</title>
     <style>
-        body {{
+        body {
             font-family: Arial, sans-serif;
             background-color: #f8f9fa;
             margin: 20px;
-        }}
-        .container {{
+        }
+        .container {
             max-width: 800px;
             margin: 0 auto;
             padding: 20px;
             background-color: white;
             border-radius: 10px;
             box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-        }}
-        header {{
+        }
+        header {
             text-align: center;
             margin-bottom: 40px;
-        }}
-        header img {{
+        }
+        header img {
             max-width: 650px;
             margin-bottom: 10px;
-        }}
-        h2 {{
+        }
+        h2 {
             color: #333;
-        }}
-        ul {{
+        }
+        ul {
             padding-left: 20px;
-        }}
-        li {{
+        }
+        li {
             margin-bottom: 10px;
-        }}
-        a {{
+        }
+        a {
             text-decoration: none;
             color: #0485d1;
-        }}
-        a:hover {{
+        }
+        a:hover {
             text-decoration: underline;
-        }}
+        }
     </style>
     </head>
     <body>
     <div class="container">
         <header>
-            <img src="{base64_image}" alt="OpenPrescribing logo">
+            <img src="{{ base64_image }}" alt="OpenPrescribing logo">
             <h2>dm+d Lookup Reports Index</h2>
         </header>
         <ul>
-    """
-
-    for i, (_, version, filename) in enumerate(version_files):
-        label = f"{version}"
-        if i == 0:
-            label += " ← Latest"
-        link = f"https://github.com/chrisjwood16/dmd_tests/blob/main/reports/{filename}"
-        html_content += f'<li><a href="{PREVIEW_BASE_URL}{link}">{label}</a></li>\n'
+    {% for _, version, filename in version_files %}
+<li><a href="{{ preview_base_url }}https://github.com/chrisjwood16/dmd_tests/blob/main/reports/{{ filename }}">{{ version }}{% if loop.first %} ← Latest{% endif %}</a></li>
+{% endfor %}
 
-    html_content += """
         </ul>
     </div>
     </body>
     </html>
-    """
+    """)
+
+def generate_dmd_lookup_index_html():
+    reports_dir = os.path.join(os.getcwd(), "reports")
+
+    # Get all report files
+    _, version_files = get_report_versions()
+
+    html_content = INDEX_TEMPLATE.render(
+        base64_image=get_base64_image(),
+        preview_base_url=get_preview_base_url(),
+        version_files=version_files
+    )
 
     output_path = os.path.join(reports_dir, "list_dmd_lookup_reports.html")
     with open(output_path, "w", encoding="utf-8") as f:
@@ -508,75 +738,59 @@ def generate_dmd_lookup_index_html():
     print(f"Index written to: {output_path}")
 
 
-class DmdCode:
-    def __init__(self, code, folder, url):
-        self.code = code
-        self.folder = folder
-        self.url = url
-        self.status = None  # e.g. "active", "inactive", "unknown"
-
-    def set_status(self, status):
-        self.status = status
-
-    def __repr__(self):
-        return f"DmdCode(code={self.code}, folder='{self.folder}', url='{self.url}', status='{self.status}')"
-
+class DmdCode(NamedTuple):
+    """
+    One report row: a code, its lookup status and a folder it was found in.
+    """
+    code: str
+    status: str  # "active", "inactive" or "unknown"
+    folder: str
+    url: str
+
+
+# Command-line arguments, configured once at import
+PARSER = argparse.ArgumentParser(description="Generate dm+d status report")
+PARSER.add_argument(
+    "--mode",
+    choices=["auto", "force"],
+    default="auto",
+    help="Specify the mode of operation. Choices are 'auto' (default) or 'force'."
+)
+PARSER.add_argument("--fail-on-problem", action="store_true")
+PARSER.add_argument(
+    "--force-check",
+    action="store_true",
+    help="In auto mode, look up the dm+d version even if it was checked in the last 24 hours."
+)
 
 def main():
-    # Create the parser
-    parser = argparse.ArgumentParser(description="Process an optional mode argument.")
-    
-    # Add the optional mode argument
-    parser.add_argument(
-        "--mode", 
-        choices=["auto", "force"], 
-        default="auto", 
-        help="Specify the mode of operation. Choices are 'auto' (default) or 'force'."
-    )
-    
-    # Parse the command-line arguments
-    args = parser.parse_args()
-    
-    # Access the mode argument
-    mode = args.mode
-
-    access_token = get_access_token()
-    existing_versions = get_report_versions()
-    version = get_dmd_version_via_lookup(access_token)
+    args = PARSER.parse_args()
 
-    if mode == "force":
-        update_reports(access_token, version)
-    elif mode == "auto":
-        if version in existing_versions:
-            print(f"Version {version} already exists in reports directory.")
-        else:
-            update_reports(access_token, version)
-
-def main():
-    parser = argparse.ArgumentParser(description="Generate dm+d status report")
-    parser.add_argument("--mode", choices=["auto", "force"], default="auto")
-    parser.add_argument("--fail-on-problem", action="store_true")
-    args = parser.parse_args()
+    if args.mode == "auto" and not args.force_check and checked_recently():
+        print("dm+d version checked within the last 24 hours, skipping lookup.")
+        return
 
     access_token = get_access_token()
-    existing_versions = get_report_versions()
+    existing_versions, _ = get_report_versions()
     version = get_dmd_version_via_lookup(access_token)
 
     should_run = args.mode == "force" or version not in existing_versions
 
     if should_run:
-        code_objects = update_reports(access_token, version)
+        code_rows = update_reports(access_token, version)
+        record_version_check()
 
         # After report is written, fail if needed
         if args.fail_on_problem:
-            problems = [obj for obj in code_objects if obj.status in ("inactive", "unknown")]
+            problems = [row for row in code_rows if row.status in ("inactive", "unknown")]
             if problems:
                 print("\nIssues detected with the following codes:\n")
-                for obj in problems:
-                    print(f"- {obj.code} ({obj.status}) in folder '{obj.folder}'")
+                for row in problems:
+                    print(f"- {row.code} ({row.status}) in folder '{row.folder}'")
                 print("\nFailing workflow due to problem codes.\n")
                 exit(1)
     else:
+        record_version_check()
         print(f"Version {version} already processed.")
 
 if __name__ == "__main__":